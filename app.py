@@ -1,47 +1,191 @@
 import os
 import re
+import json
 import time
 import uuid
+import mmap
+import heapq
+import queue
 import base64
+import hashlib
+import html
+import logging
 import zipfile
 import tempfile
 import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
 
-from flask import Flask, render_template, request, send_file
+from flask import Flask, jsonify, render_template, request, send_file
 from email_validator import validate_email, EmailNotValidError
 
 import yt_dlp
-from pydub import AudioSegment
 
 from sendgrid import SendGridAPIClient
 from sendgrid.helpers.mail import (
-    Mail, Attachment, FileContent, FileName, FileType, Disposition
+    Mail, Attachment, FileContent, FileName, FileType, Disposition, Personalization, To
 )
 
 app = Flask(__name__)
+# Behind a proxy that honours X-Sendfile, let it serve /download bytes itself.
+app.config["USE_X_SENDFILE"] = os.getenv("USE_X_SENDFILE", "") == "1"
+
+# LOG_TIMING=1 logs one JSON line per pipeline stage (see timed()).
+LOG_TIMING = os.getenv("LOG_TIMING", "") == "1"
+if LOG_TIMING:
+    app.logger.setLevel(logging.INFO)
 
 # ----------------------------
 # Download cache (Render uses ephemeral disk; links expire)
+# State lives only on disk: DOWNLOAD_CACHE_DIR/<token>/ holds the job's
+# status.json and, once built, its ZIP. Aged by mtime, so it is shared by
+# all gunicorn workers and survives a restart. The token is also the job id.
 # ----------------------------
 DOWNLOAD_CACHE_DIR = Path("/tmp/mashup_cache")
 DOWNLOAD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 DOWNLOAD_TTL_SECONDS = 20 * 60  # 20 minutes
-DOWNLOADS = {}  # token -> {"path": Path, "created": ts, "filename": str}
+CLEANUP_INTERVAL_SECONDS = 60
+TOKEN_RE = re.compile(r"[0-9a-f]{32}")
+ACTIVE_JOB_STATES = ("queued", "running")
+
+# Bigger ZIPs are emailed as a download link instead of an attachment.
+ATTACHMENT_MAX_BYTES = 5 * 1024 * 1024
+# Without PUBLIC_BASE_URL there is no link to send, so attach up to this size
+# (base64 grows it by 4/3; stays under SendGrid's 30 MB message limit).
+ATTACHMENT_FALLBACK_MAX_BYTES = 20 * 1024 * 1024
+# Public origin for links in emails, e.g. https://mashup.onrender.com.
+# Never derived from the request's Host header (client-controlled).
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").strip().rstrip("/")
+
+# Mashups run in the background; the request thread only validates and enqueues.
+# Long-lived threads: no fork per job. Size to what the dyno's CPU/RAM can take.
+JOB_WORKERS = max(1, int(os.getenv("WORKER_CONCURRENCY", "2")))
+JOBS = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="mashup-job")
+# Queued + running jobs per process; further submissions get a "busy" error.
+MAX_PENDING_JOBS = 4 * JOB_WORKERS
+JOB_SLOTS = threading.BoundedSemaphore(MAX_PENDING_JOBS)
+
+# ----------------------------
+# Scratch space: small jobs work in RAM (tmpfs) instead of on the slow
+# ephemeral disk; bigger ones, or hosts without /dev/shm, fall back to /tmp.
+# ----------------------------
+# MASHUP_SCRATCH pins the parent dir for every job (e.g. a bigger tmpfs mount).
+# Checked once at startup; a missing or read-only dir falls back to the default.
+def _checked_scratch(path):
+    if not path:
+        return None
+    if os.path.isdir(path) and os.access(path, os.W_OK | os.X_OK):
+        return path
+    app.logger.warning("MASHUP_SCRATCH=%r is not a writable directory; ignoring it.", path)
+    return None
+
+
+MASHUP_SCRATCH = _checked_scratch(os.getenv("MASHUP_SCRATCH", "").strip())
+RAM_SCRATCH_DIR = Path("/dev/shm")
+RAM_SCRATCH_MAX_BYTES = 64 * 1024 * 1024
+TRACK_ESTIMATE_BYTES = 12 * 1024 * 1024  # raw download + mp3 of a ~5 min track
+
+# ----------------------------
+# Track cache: downloaded mp3s keyed by video id, shared across jobs so
+# popular searches skip YouTube entirely. Least recently used first out.
+# ----------------------------
+TRACK_CACHE_DIR = Path("/tmp/ytcache")
+TRACK_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+TRACK_CACHE_MAX_BYTES = 2 * 1024 ** 3  # 2 GB
+
+# Search results (query, n) -> video ids, so a repeat search skips YouTube.
+SEARCH_CACHE_DIR = TRACK_CACHE_DIR / "search"
+SEARCH_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+SEARCH_CACHE_TTL_SECONDS = 60 * 60
+
+# ----------------------------
+# Download concurrency (adaptive)
+# Start low and only grow while throughput keeps improving:
+# many parallel fetches from one IP trip YouTube's bot checks.
+# ----------------------------
+DOWNLOAD_START_WORKERS = 2
+MAX_DOWNLOAD_WORKERS = 4
+ADAPT_WINDOW_SECONDS = 5
+THROUGHPUT_EWMA_ALPHA = 0.5
+THROTTLE_MARKERS = ("HTTP Error 429", "HTTP Error 403")
+
+# Every track is converted to this layout so clips can be joined by stream copy.
+MASHUP_FRAME_RATE = 44100
+MASHUP_CHANNELS = 2
+ZIP_WRITE_CHUNK = 1024 * 1024
 
 
 def cleanup_downloads():
+    """
+    Remove expired job dirs. A dir's mtime only moves when status.json is
+    rewritten, so queued/running jobs are never swept on age alone.
+    """
     now = time.time()
-    expired = [t for t, meta in DOWNLOADS.items() if now - meta["created"] > DOWNLOAD_TTL_SECONDS]
-    for t in expired:
-        try:
-            p = DOWNLOADS[t]["path"]
-            if p.exists():
-                p.unlink()
-        except:
-            pass
-        DOWNLOADS.pop(t, None)
+    with os.scandir(DOWNLOAD_CACHE_DIR) as it:
+        for entry in it:
+            try:
+                if now - entry.stat().st_mtime <= DOWNLOAD_TTL_SECONDS:
+                    continue
+            except OSError:
+                continue
+            status = read_job_status(entry.name)
+            if status and status.get("state") in ACTIVE_JOB_STATES:
+                if not _pid_alive(status.get("pid")):
+                    # Owner process is gone (worker restart): the job will never finish.
+                    try:
+                        write_job_status(entry.name, "failed", error="Server restarted. Please generate again.")
+                    except OSError:
+                        pass
+                continue
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _pid_alive(pid) -> bool:
+    if not isinstance(pid, int):
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _schedule_cleanup():
+    """
+    Sweep expired downloads every CLEANUP_INTERVAL_SECONDS, off the request path.
+    The next run is always armed, so one failed sweep never stops the sweeper.
+    """
+    try:
+        DOWNLOAD_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        cleanup_downloads()
+    except Exception:
+        app.logger.exception("Download cleanup failed")
+    finally:
+        t = threading.Timer(CLEANUP_INTERVAL_SECONDS, _schedule_cleanup)
+        t.daemon = True
+        t.start()
+
+
+@contextmanager
+def timed(stage: str, **fields):
+    """
+    Log how long the wrapped block took, as a JSON line (only if LOG_TIMING).
+    """
+    if not LOG_TIMING:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        app.logger.info(json.dumps({"stage": stage, "seconds": round(time.perf_counter() - start, 3), **fields}))
 
 
 def safe_int(x, default=0):
@@ -51,18 +195,21 @@ def safe_int(x, default=0):
         return default
 
 
+UNSAFE_FILENAME_RE = re.compile(r"[^a-zA-Z0-9._-]+")
+
+
 def sanitize_filename(name: str) -> str:
-    name = re.sub(r"[^a-zA-Z0-9._-]+", "_", name).strip("_")
+    name = UNSAFE_FILENAME_RE.sub("_", name).strip("_")
     return name or "mashup"
 
 
-def _yt_dlp_opts(out_dir: Path):
+def _yt_dlp_opts(out_dir: Path, progress_hook=None):
     """
     yt-dlp options tuned for server stability.
     Note: YouTube may still block cloud IPs sometimes.
     """
     outtmpl = str(out_dir / "%(id)s.%(ext)s")
-    return {
+    opts = {
         "format": "bestaudio/best",
         "outtmpl": outtmpl,
         "noplaylist": True,
@@ -73,186 +220,683 @@ def _yt_dlp_opts(out_dir: Path):
         # Helps in some cases (not guaranteed)
         "extractor_args": {"youtube": {"player_client": ["android"]}},
         "http_headers": {"User-Agent": "Mozilla/5.0"},
-        "postprocessors": [{
-            "key": "FFmpegExtractAudio",
-            "preferredcodec": "mp3",
-            "preferredquality": "192",
-        }],
+        # No postprocessors: mp3 conversion runs on its own pool (convert_to_mp3)
+        # so the download slot is freed as soon as the bytes are in.
     }
+    if progress_hook:
+        opts["progress_hooks"] = [progress_hook]
+    return opts
 
 
-def download_n_audios_by_search(singer: str, n: int, out_dir: Path):
+class DownloadThrottle:
     """
-    Uses ytsearchN to download top N results.
+    Closed-loop concurrency limit for parallel downloads.
+    yt-dlp's progress hook feeds byte counts in; every ADAPT_WINDOW_SECONDS the
+    limit grows by one if smoothed throughput rose >10%, and shrinks on a
+    throughput drop or when YouTube starts throttling (HTTP 429/403).
+    """
+
+    def __init__(self, start: int, ceiling: int):
+        self.limit = max(1, min(start, ceiling))
+        self.ceiling = ceiling
+        self._active = 0
+        self._cond = threading.Condition()
+        self._window_bytes = 0
+        self._seen = {}  # filename -> downloaded_bytes already counted
+        self._ewma = None
+        self._throttled = False
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= self.limit:
+                self._cond.wait()
+            self._active += 1
+
+    def release(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def progress_hook(self, d):
+        if d.get("status") != "downloading":
+            return
+        key = d.get("filename")
+        done = d.get("downloaded_bytes") or 0
+        with self._cond:
+            self._window_bytes += max(0, done - self._seen.get(key, 0))
+            self._seen[key] = done
+
+    def back_off(self):
+        with self._cond:
+            self._throttled = True
+            self.limit = max(1, self.limit - 1)
+
+    def adjust(self, window_seconds: float):
+        with self._cond:
+            rate = self._window_bytes / window_seconds
+            self._window_bytes = 0
+            prev = self._ewma
+            if prev is None:
+                self._ewma = rate
+                return
+            self._ewma = THROUGHPUT_EWMA_ALPHA * rate + (1 - THROUGHPUT_EWMA_ALPHA) * prev
+
+            if self._throttled:
+                self._throttled = False  # already backed off for this window
+            elif self._ewma > 1.1 * prev and self.limit < self.ceiling:
+                self.limit += 1
+                self._cond.notify_all()
+            elif self._ewma < 0.9 * prev and self.limit > 1:
+                self.limit -= 1
+
+    def control_loop(self, stop: threading.Event):
+        while not stop.wait(ADAPT_WINDOW_SECONDS):
+            self.adjust(ADAPT_WINDOW_SECONDS)
+
+
+def _is_throttled(err: Exception) -> bool:
+    msg = str(err)
+    return any(m in msg for m in THROTTLE_MARKERS)
+
+
+def list_video_ids(query: str, n: int):
     """
-    search = f"ytsearch{n}:{singer} official audio"
-    with yt_dlp.YoutubeDL(_yt_dlp_opts(out_dir)) as ydl:
-        ydl.download([search])
+    Metadata-only search: returns up to n distinct video ids without
+    downloading anything. Distinct matters: two workers fetching the same id
+    would race on the same %(id)s output file.
+    Results are cached on disk for SEARCH_CACHE_TTL_SECONDS.
+    """
+    normalized = " ".join(query.lower().split())
+    key = hashlib.sha1(f"{normalized}\n{n}".encode()).hexdigest()
+    cached = SEARCH_CACHE_DIR / f"{key}.json"
+    try:
+        if time.time() - cached.stat().st_mtime < SEARCH_CACHE_TTL_SECONDS:
+            return json.loads(cached.read_text())
+    except (OSError, ValueError):
+        pass
+
+    opts = {"quiet": True, "no_warnings": True, "extract_flat": True, "skip_download": True}
+    with yt_dlp.YoutubeDL(opts) as ydl:
+        info = ydl.extract_info(f"ytsearch{n}:{query}", download=False)
+
+    entries = (info or {}).get("entries") or []
+    ids = list(dict.fromkeys(e["id"] for e in entries if e and e.get("id")))[:n]
 
-    return sorted(out_dir.glob("*.mp3"))
+    if ids:  # an empty result may be a transient block; don't pin it
+        tmp = SEARCH_CACHE_DIR / f".{key}.{uuid.uuid4().hex}.tmp"
+        try:
+            tmp.write_text(json.dumps(ids))
+            os.replace(tmp, cached)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+    return ids
+
+
+def download_one(video_id: str, out_dir: Path, progress_hook=None) -> Path:
+    """
+    Download the raw best audio stream; returns its path.
+    """
+    with yt_dlp.YoutubeDL(_yt_dlp_opts(out_dir, progress_hook)) as ydl:
+        info = ydl.extract_info(f"https://youtu.be/{video_id}", download=True)
+        return Path(ydl.prepare_filename(info))
+
+
+def convert_to_mp3(raw: Path) -> Path:
+    """
+    Raw download -> 192k mp3 next to it, in the canonical rate/channel layout.
+    """
+    if raw.suffix == ".mp3":
+        return raw
+    mp3 = raw.with_suffix(".mp3")
+    subprocess.run(
+        [
+            "ffmpeg", "-v", "error", "-y", "-i", str(raw), "-vn",
+            "-ar", str(MASHUP_FRAME_RATE), "-ac", str(MASHUP_CHANNELS),
+            "-codec:a", "libmp3lame", "-b:a", "192k",
+            str(mp3),
+        ],
+        check=True,
+    )
+    raw.unlink(missing_ok=True)
+    return mp3
+
+
+def _link_or_copy(src: Path, dst: Path):
+    try:
+        os.link(src, dst)
+    except OSError:  # e.g. across filesystems
+        shutil.copyfile(src, dst)
+
+
+def use_cached_track(video_id: str, out_dir: Path) -> bool:
+    """
+    Hard-link a cached track into out_dir; the link keeps it alive even if
+    the cache evicts it mid-job.
+    """
+    cached = TRACK_CACHE_DIR / f"{video_id}.mp3"
+    try:
+        if cached.stat().st_size == 0:
+            return False
+        _link_or_copy(cached, out_dir / cached.name)
+        os.utime(cached)  # LRU: mtime = last use
+    except OSError:
+        return False
+    return True
+
+
+def cache_track(mp3: Path):
+    """
+    Insert a freshly downloaded track; the rename makes it appear atomically.
+    """
+    tmp = TRACK_CACHE_DIR / f".{mp3.stem}.{uuid.uuid4().hex}.tmp"
+    try:
+        _link_or_copy(mp3, tmp)
+        os.replace(tmp, TRACK_CACHE_DIR / mp3.name)
+    except OSError:
+        tmp.unlink(missing_ok=True)
+
+
+def evict_track_cache():
+    """
+    Drop least recently used tracks until the cache fits TRACK_CACHE_MAX_BYTES,
+    and expired search results.
+    """
+    now = time.time()
+    with os.scandir(SEARCH_CACHE_DIR) as it:
+        for entry in it:
+            try:
+                if now - entry.stat().st_mtime > SEARCH_CACHE_TTL_SECONDS:
+                    os.unlink(entry.path)
+            except OSError:
+                pass
+
+    entries = []
+    with os.scandir(TRACK_CACHE_DIR) as it:
+        for entry in it:
+            if entry.name.endswith(".mp3"):
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    heapq.heapify(entries)
+    while total > TRACK_CACHE_MAX_BYTES and entries:
+        _, size, path = heapq.heappop(entries)
+        try:
+            os.unlink(path)
+            total -= size
+        except OSError:
+            pass
+
+
+def download_n_audios_by_search(singer: str, n: int, out_dir: Path):
+    """
+    Searches once for the top N results, takes what it can from the track
+    cache, then downloads the rest from a pool of worker threads gated by a
+    DownloadThrottle (the work is network-bound).
+    Finished downloads are converted to mp3 on a separate CPU-sized pool, so
+    ffmpeg runs while the next videos are still downloading.
+    A throttled video is retried once at the reduced concurrency.
+    Raises the first download error only if nothing could be downloaded.
+    """
+    ids = list_video_ids(f"{singer} official audio", n)
+    misses = [vid for vid in ids if not use_cached_track(vid, out_dir)]
+    if not misses:
+        return sorted(out_dir.glob("*.mp3"))
+
+    throttle = DownloadThrottle(DOWNLOAD_START_WORKERS, MAX_DOWNLOAD_WORKERS)
+    pending = queue.Queue()
+    for vid in misses:
+        pending.put((vid, 1))
+    errors = []
+    conversions = []
+
+    def worker():
+        while True:
+            try:
+                vid, attempt = pending.get_nowait()
+            except queue.Empty:
+                return
+            throttle.acquire()
+            try:
+                raw = download_one(vid, out_dir, throttle.progress_hook)
+            except yt_dlp.utils.DownloadError as e:
+                if _is_throttled(e):
+                    throttle.back_off()
+                    if attempt < 2:
+                        pending.put((vid, attempt + 1))
+                        continue
+                errors.append(e)
+                continue
+            finally:
+                throttle.release()
+            conversions.append(converter.submit(convert_to_mp3, raw))
+
+    stop = threading.Event()
+    controller = threading.Thread(target=throttle.control_loop, args=(stop,), daemon=True)
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(min(len(misses), MAX_DOWNLOAD_WORKERS))]
+    with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as converter:
+        controller.start()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        stop.set()
+
+        for fut in conversions:
+            try:
+                cache_track(fut.result())
+            except subprocess.CalledProcessError as e:
+                errors.append(e)
+    evict_track_cache()
+
+    mp3s = sorted(out_dir.glob("*.mp3"))
+    if not mp3s and errors:
+        raise errors[0]
+    return mp3s
+
+
+def trim_clip(src: Path, seconds: int, out_dir: Path) -> Path:
+    """
+    First `seconds` of an mp3, cut on frame boundaries by stream copy:
+    nothing is decoded or re-encoded.
+    """
+    out = out_dir / src.name
+    subprocess.run(
+        ["ffmpeg", "-v", "error", "-y", "-i", str(src), "-t", str(seconds), "-vn", "-c", "copy", str(out)],
+        check=True,
+    )
+    return out
 
 
-def build_mashup(mp3_files, seconds_each: int, out_mp3: Path):
-    merged = AudioSegment.silent(duration=0)
-    clip_ms = max(1, seconds_each) * 1000
+def _audio_layout(path: Path) -> str:
+    """
+    "codec,sample_rate,channels" of the first audio stream, via ffprobe.
+    """
+    proc = subprocess.run(
+        [
+            "ffprobe", "-v", "error", "-select_streams", "a:0",
+            "-show_entries", "stream=codec_name,sample_rate,channels", "-of", "csv=p=0",
+            str(path),
+        ],
+        stdout=subprocess.PIPE,
+        check=True,
+        text=True,
+    )
+    return proc.stdout.strip()
 
-    for f in mp3_files:
-        audio = AudioSegment.from_file(f)
-        merged += audio[:clip_ms]
 
-    merged.export(out_mp3, format="mp3")
+def build_mashup(mp3_files, seconds_each: int, out):
+    """
+    Trims every clip by stream copy, then joins them with ffmpeg's concat
+    demuxer (-c copy). Tracks normally share one mp3 layout (see
+    convert_to_mp3), so the whole mashup is built without a decode or a LAME
+    pass; if any clip differs, the join falls back to re-encoding.
+    The mp3 is written to `out` (a writable binary file object).
+    Consumes mp3_files: each is deleted once trimmed, and the trims go with
+    their temp dir right after the join, so peak scratch use stays ~one stage.
+    """
+    seconds = max(1, seconds_each)
+
+    with tempfile.TemporaryDirectory(prefix="trims_", dir=Path(mp3_files[0]).parent) as tmp:
+        trims_dir = Path(tmp)
+
+        def try_trim(f):
+            try:
+                return trim_clip(Path(f), seconds, trims_dir)
+            except subprocess.CalledProcessError:
+                app.logger.warning("Skipping clip ffmpeg could not read: %s", f)
+                return None
+
+        # Each trim/probe is an independent ffmpeg process; map keeps input order.
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 2) as ex:
+            trimmed = [t for t in ex.map(try_trim, mp3_files) if t is not None]
+            if not trimmed:
+                raise RuntimeError("No valid audio to build the mashup from.")
+            layouts = set(ex.map(_audio_layout, trimmed))
+
+        # Full-length tracks are no longer needed (the track cache keeps its own link).
+        for f in mp3_files:
+            Path(f).unlink(missing_ok=True)
+
+        concat_list = trims_dir / "concat.txt"
+        concat_list.write_text("".join(
+            "file '{}'\n".format(str(t).replace("'", "'\\''")) for t in trimmed
+        ))
+
+        if len(layouts) == 1:
+            codec = ["-c", "copy"]
+        else:
+            codec = [
+                "-ar", str(MASHUP_FRAME_RATE), "-ac", str(MASHUP_CHANNELS),
+                "-codec:a", "libmp3lame", "-b:a", "192k",
+            ]
+
+        proc = subprocess.Popen(
+            [
+                "ffmpeg", "-v", "error",
+                "-f", "concat", "-safe", "0", "-i", str(concat_list),
+                *codec, "-f", "mp3", "pipe:1",
+            ],
+            stdout=subprocess.PIPE,
+        )
+        # 1 MiB blocks mean fewer Python-level write()/zlib.crc32 calls per member.
+        with proc.stdout:
+            shutil.copyfileobj(proc.stdout, out, ZIP_WRITE_CHUNK)
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise RuntimeError(f"ffmpeg concat failed (exit {proc.returncode}).")
+
+
+def make_zip(mp3_files, seconds_each: int, zip_path: Path, arcname: str):
+    """
+    Encodes the mashup directly into the archive member; no mp3 on disk.
+    Stored, not deflated: mp3 is already compressed, DEFLATE saves ~0%.
+    """
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_STORED) as zf:
+        with zf.open(arcname, "w") as member:
+            build_mashup(mp3_files, seconds_each, member)
 
 
-def make_zip(file_path: Path, zip_path: Path):
-    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zf:
-        zf.write(file_path, arcname=file_path.name)
+@lru_cache(maxsize=1)
+def _sendgrid_client(api_key: str):
+    """
+    One client per API key, reused across jobs (rebuilt only if the key changes).
+    """
+    return SendGridAPIClient(api_key)
 
 
-def send_zip_via_sendgrid(to_email: str, zip_path: Path):
+def send_zip_via_sendgrid(to_emails, zip_path: Path, download_path: str) -> str:
     """
     Requires env vars:
     - SENDGRID_API_KEY
     - FROM_EMAIL   (must be verified in SendGrid: Single Sender or Domain Auth)
+
+    Small ZIPs are attached; larger ones are sent as a download link so the
+    API call stays tiny (and under SendGrid's 30 MB limit). The link needs
+    PUBLIC_BASE_URL; without it ZIPs up to ATTACHMENT_FALLBACK_MAX_BYTES are
+    still attached, and anything bigger just points back to the web page.
+    All recipients go out in one API call, one personalization each
+    (so nobody sees the other addresses); duplicates are sent once.
+    Returns what was sent: "zip", "link" or "none".
     """
     api_key = os.getenv("SENDGRID_API_KEY", "").strip()
     from_email = os.getenv("FROM_EMAIL", "").strip()
     if not api_key or not from_email:
         raise RuntimeError("SendGrid not configured (SENDGRID_API_KEY / FROM_EMAIL missing).")
 
-    with open(zip_path, "rb") as f:
-        data = f.read()
-
-    encoded = base64.b64encode(data).decode()
+    size = zip_path.stat().st_size
+    attach = size <= ATTACHMENT_MAX_BYTES or (not PUBLIC_BASE_URL and size <= ATTACHMENT_FALLBACK_MAX_BYTES)
+    expires = f"expires in {DOWNLOAD_TTL_SECONDS // 60} min"
+    if attach:
+        sent = "zip"
+        html_content = "<p>Your mashup ZIP is attached.</p>"
+    elif PUBLIC_BASE_URL:
+        sent = "link"
+        url = html.escape(PUBLIC_BASE_URL + download_path)
+        html_content = f'<p>Download: <a href="{url}">{html.escape(zip_path.name)}</a> ({expires}).</p>'
+    else:
+        sent = "none"
+        html_content = (
+            "<p>Your mashup is too large to attach. "
+            f"Use the download button on the page where you created it ({expires}).</p>"
+        )
 
     message = Mail(
         from_email=from_email,
-        to_emails=to_email,
         subject="Mashup ZIP file",
-        html_content="<p>Your mashup ZIP is attached.</p>"
+        html_content=html_content
     )
+    seen = set()
+    for addr in to_emails:
+        if addr.lower() in seen:
+            continue
+        seen.add(addr.lower())
+        p = Personalization()
+        p.add_to(To(addr))
+        message.add_personalization(p)
+
+    if attach:
+        # mmap skips the read() copy; b64encode takes the buffer directly.
+        with open(zip_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            encoded = base64.b64encode(mm).decode("ascii")
+
+        message.attachment = Attachment(
+            FileContent(encoded),
+            FileName(zip_path.name),
+            FileType("application/zip"),
+            Disposition("attachment"),
+        )
+
+    _sendgrid_client(api_key).send(message)
+    return sent
+
+
+def scratch_dir_for(n: int):
+    """
+    Parent dir for a job's temp files: MASHUP_SCRATCH if set, else tmpfs when
+    n tracks comfortably fit, else None (tempfile's default).
+    """
+    if MASHUP_SCRATCH:
+        return MASHUP_SCRATCH
+    need = n * TRACK_ESTIMATE_BYTES
+    if need > RAM_SCRATCH_MAX_BYTES or not RAM_SCRATCH_DIR.is_dir():
+        return None
+    try:
+        if shutil.disk_usage(RAM_SCRATCH_DIR).free < 2 * need:
+            return None
+    except OSError:
+        return None
+    return str(RAM_SCRATCH_DIR)
 
-    attachment = Attachment(
-        FileContent(encoded),
-        FileName(zip_path.name),
-        FileType("application/zip"),
-        Disposition("attachment"),
-    )
-    message.attachment = attachment
 
-    sg = SendGridAPIClient(api_key)
-    sg.send(message)
+def publish_download(token: str, zip_path: Path):
+    """
+    Move a finished zip into the token's cache dir; returns its new path.
+    """
+    target = DOWNLOAD_CACHE_DIR / token / zip_path.name
+    shutil.move(zip_path, target)
+    return target
 
 
-def cache_zip_for_download(zip_path: Path, display_name: str):
+def cached_download(token: str):
     """
-    Copy zip into /tmp cache and return token.
+    Path of a live cached download, or None if the token is unknown or expired.
     """
-    cleanup_downloads()
-    token = uuid.uuid4().hex
-    target = DOWNLOAD_CACHE_DIR / f"{token}.zip"
-    target.write_bytes(zip_path.read_bytes())
-    DOWNLOADS[token] = {"path": target, "created": time.time(), "filename": display_name}
-    return token
+    if not TOKEN_RE.fullmatch(token):
+        return None
+    try:
+        p = next((DOWNLOAD_CACHE_DIR / token).glob("*.zip"))
+        if time.time() - p.stat().st_mtime > DOWNLOAD_TTL_SECONDS:
+            return None
+    except (OSError, StopIteration):
+        return None
+    return p
 
 
-@app.route("/", methods=["GET", "POST"])
-def index():
-    cleanup_downloads()
+def write_job_status(job_id: str, state: str, success=None, error=None, download_url=None):
+    """
+    Atomically replace the job's status.json (polled by /status/<job_id>).
+    Records the writing process so the sweeper can spot jobs orphaned by a
+    worker restart.
+    """
+    job_dir = DOWNLOAD_CACHE_DIR / job_id
+    tmp = job_dir / f"status.json.{os.getpid()}.tmp"
+    tmp.write_text(json.dumps({
+        "state": state,
+        "success": success,
+        "error": error,
+        "download_url": download_url,
+        "pid": os.getpid(),
+    }))
+    os.replace(tmp, job_dir / "status.json")
+
+
+def read_job_status(job_id: str):
+    if not TOKEN_RE.fullmatch(job_id):
+        return None
+    try:
+        return json.loads((DOWNLOAD_CACHE_DIR / job_id / "status.json").read_text())
+    except (OSError, ValueError):
+        return None
 
-    if request.method == "GET":
-        return render_template("index.html")
 
-    singer = (request.form.get("singer") or "").strip()
-    n = safe_int(request.form.get("n"), 0)
-    y = safe_int(request.form.get("y"), 0)
-    email = (request.form.get("email") or "").strip()
+def run_mashup_job(job_id: str, singer: str, n: int, y: int, email: str):
+    """
+    Full pipeline for one submission; every outcome ends up in status.json.
+    """
+    tmp_root = None
 
-    # ---- Assignment validations ----
-    if not singer:
-        return render_template("index.html", error="Singer name is required.")
-    if n <= 0 or n > 20:
-        return render_template("index.html", error="Number of videos (n) must be between 1 and 20.")
-    if y <= 0 or y > 60:
-        return render_template("index.html", error="Duration (y) must be between 1 and 60 seconds.")
-    if not email:
-        return render_template("index.html", error="Email is required (as per assignment).")
     try:
-        validate_email(email)
-    except EmailNotValidError:
-        return render_template("index.html", error="Invalid email format. Please enter a correct email.")
-
-    tmp_root = Path(tempfile.mkdtemp(prefix="mashup_"))
+        write_job_status(job_id, "running")
+        tmp_root = Path(tempfile.mkdtemp(prefix="mashup_", dir=scratch_dir_for(n)))
 
-    try:
         dl_dir = tmp_root / "downloads"
         dl_dir.mkdir(parents=True, exist_ok=True)
 
         # 1) Download audio
         try:
-            mp3s = download_n_audios_by_search(singer, n, dl_dir)
+            with timed("download", job=job_id, n=n):
+                mp3s = download_n_audios_by_search(singer, n, dl_dir)
         except Exception as e:
-            return render_template(
-                "index.html",
+            write_job_status(
+                job_id, "failed",
                 error=(
                     "YouTube blocked downloads on the server (bot/sign-in check). "
                     "This is common on cloud hosting. Try smaller n (5–10), or demo locally. "
                     f"Details: {str(e)[:240]}"
                 )
             )
+            return
 
         if not mp3s:
-            return render_template("index.html", error="No audios downloaded. Try another singer keyword.")
+            write_job_status(job_id, "failed", error="No audios downloaded. Try another singer keyword.")
+            return
 
-        # 2) Build mashup mp3
+        # 2) Build mashup mp3 straight into the ZIP
         base = sanitize_filename(singer)
-        out_mp3 = tmp_root / f"{base}_mashup.mp3"
-        build_mashup(mp3s, y, out_mp3)
-
-        # 3) Make ZIP
         out_zip = tmp_root / f"{base}_mashup.zip"
-        make_zip(out_mp3, out_zip)
+        with timed("mashup_zip", job=job_id, clips=len(mp3s), y=y):
+            make_zip(mp3s, y, out_zip, f"{base}_mashup.mp3")
 
-        # 4) Backup download link (always)
-        token = cache_zip_for_download(out_zip, out_zip.name)
-        download_url = f"/download/{token}"
+        # 3) Backup download link (always)
+        zip_path = publish_download(job_id, out_zip)
+        download_url = f"/download/{job_id}"
 
-        # 5) Email ZIP
+        # 4) Email ZIP (or a link to it)
         try:
-            send_zip_via_sendgrid(email, out_zip)
-            return render_template(
-                "index.html",
-                success=f"✅ ZIP sent to: {email}",
+            with timed("email", job=job_id):
+                sent = send_zip_via_sendgrid([email], zip_path, download_url)
+            if sent == "zip":
+                success = f"✅ ZIP sent to: {email}"
+            elif sent == "link":
+                success = f"✅ Download link sent to: {email}"
+            else:
+                success = f"✅ Email sent to: {email} (ZIP too large to attach). Download below."
+            write_job_status(
+                job_id, "finished",
+                success=success,
                 download_url=download_url
             )
         except Exception as e:
             # Email failed -> still give download link
-            return render_template(
-                "index.html",
+            write_job_status(
+                job_id, "finished",
                 error=f"Email failed, but ZIP is ready. Download below. Reason: {str(e)[:240]}",
                 download_url=download_url
             )
 
+    except Exception as e:
+        app.logger.exception("Mashup job %s failed", job_id)
+        write_job_status(job_id, "failed", error=f"Mashup failed: {str(e)[:240]}")
+
     finally:
-        shutil.rmtree(tmp_root, ignore_errors=True)
+        if tmp_root:
+            shutil.rmtree(tmp_root, ignore_errors=True)
+
+
+@lru_cache(maxsize=None)
+def error_page(message: str) -> str:
+    """
+    Rendered index page for a fixed validation error; rendered once, then reused.
+    Only pass static messages here; anything with user data must go through
+    render_template directly.
+    """
+    return render_template("index.html", error=message)
+
+
+@app.route("/", methods=["GET", "POST"])
+def index():
+    if request.method == "GET":
+        return render_template("index.html")
+
+    singer = (request.form.get("singer") or "").strip()
+    n = safe_int(request.form.get("n"), 0)
+    y = safe_int(request.form.get("y"), 0)
+    email = (request.form.get("email") or "").strip()
+
+    # ---- Assignment validations ----
+    if not singer:
+        return error_page("Singer name is required.")
+    if n <= 0 or n > 20:
+        return error_page("Number of videos (n) must be between 1 and 20.")
+    if y <= 0 or y > 60:
+        return error_page("Duration (y) must be between 1 and 60 seconds.")
+    if not email:
+        return error_page("Email is required (as per assignment).")
+    try:
+        validate_email(email)
+    except EmailNotValidError:
+        return error_page("Invalid email format. Please enter a correct email.")
+
+    if not JOB_SLOTS.acquire(blocking=False):
+        return error_page("Server is busy with other mashups. Please try again in a few minutes.")
+    try:
+        job_id = uuid.uuid4().hex
+        (DOWNLOAD_CACHE_DIR / job_id).mkdir()
+        write_job_status(job_id, "queued")
+        future = JOBS.submit(run_mashup_job, job_id, singer, n, y, email)
+    except Exception:
+        JOB_SLOTS.release()
+        raise
+    future.add_done_callback(lambda _: JOB_SLOTS.release())
+
+    return render_template("index.html", job_id=job_id)
+
+
+@app.route("/status/<job_id>")
+def status(job_id):
+    s = read_job_status(job_id)
+    if s is None:
+        return jsonify(state="unknown", error="Job expired or invalid. Please generate again."), 404
+    s.pop("pid", None)
+    return jsonify(s)
 
 
 @app.route("/download/<token>")
 def download(token):
-    cleanup_downloads()
-    meta = DOWNLOADS.get(token)
-    if not meta:
+    p = cached_download(token)
+    if p is None:
         return "Download link expired or invalid. Please generate again.", 404
 
-    p = meta["path"]
-    if not p.exists():
-        return "File not found (server restarted). Please generate again.", 404
-
-    return send_file(
+    resp = send_file(
         p,
         as_attachment=True,
-        download_name=meta["filename"],
-        mimetype="application/zip"
+        download_name=p.name,
+        mimetype="application/zip",
+        conditional=True,
+        max_age=DOWNLOAD_TTL_SECONDS,
     )
+    # Per-user file: the browser may cache it, shared caches must not.
+    resp.cache_control.public = False
+    resp.cache_control.private = True
+    return resp
+
+
+_schedule_cleanup()
 
 
 if __name__ == "__main__":